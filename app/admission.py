@@ -0,0 +1,217 @@
+import asyncio
+import math
+import os
+import weakref
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, Tuple
+
+import redis.asyncio as redis
+from fastapi import HTTPException, status
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+AI_REQUESTS_PER_MINUTE = float(os.getenv("AI_REQUESTS_PER_MINUTE", "20"))
+AI_REQUEST_BURST = float(os.getenv("AI_REQUEST_BURST", "5"))
+AI_TOKENS_PER_MINUTE = float(os.getenv("AI_TOKENS_PER_MINUTE", "20000"))
+AI_TOKEN_BURST = float(os.getenv("AI_TOKEN_BURST", "4000"))
+AI_MAX_QUEUED_PER_USER = int(os.getenv("AI_MAX_QUEUED_PER_USER", "2"))
+AI_QUEUE_RETRY_AFTER = int(os.getenv("AI_QUEUE_RETRY_AFTER", "5"))
+
+# Refills every bucket in KEYS from Redis server time, then takes each bucket's `cost` only if every bucket
+# holds at least its `required` amount. ARGV carries capacity, rate, cost, required per key, in key order.
+# Returns {allowed, seconds until every bucket would allow, index of the first bucket that blocked (0 if none)}.
+_TOKEN_BUCKET = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels, capacities, rates, costs = {}, {}, {}, {}
+local blocked = 0
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local base = (i - 1) * 4
+    capacities[i] = tonumber(ARGV[base + 1])
+    rates[i] = tonumber(ARGV[base + 2])
+    costs[i] = tonumber(ARGV[base + 3])
+    local required = tonumber(ARGV[base + 4])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacities[i]
+    local ts = tonumber(state[2]) or now
+    levels[i] = math.min(capacities[i], tokens + (now - ts) * rates[i])
+    if levels[i] < required then
+        if blocked == 0 then
+            blocked = i
+        end
+        retry_after = math.max(retry_after, (required - levels[i]) / rates[i])
+    end
+end
+for i, key in ipairs(KEYS) do
+    if blocked == 0 then
+        levels[i] = levels[i] - costs[i]
+    end
+    redis.call('HSET', key, 'tokens', levels[i], 'ts', now)
+    redis.call('EXPIRE', key, math.ceil((capacities[i] - math.min(levels[i], 0)) / rates[i]) + 1)
+end
+local allowed = 0
+if blocked == 0 then
+    allowed = 1
+end
+return {allowed, tostring(retry_after), blocked}
+"""
+
+redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+_token_bucket = redis_client.register_script(_TOKEN_BUCKET)
+
+
+def _too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+async def _take(*buckets: Tuple[str, float, float, float, float]) -> Tuple[bool, float, int]:
+    """Atomically take from (key, capacity, per_minute, cost, required) buckets, all or none."""
+    keys, args = [], []
+    for key, capacity, per_minute, cost, required in buckets:
+        keys.append(key)
+        args.extend([capacity, per_minute / 60, cost, required])
+    allowed, retry_after, blocked = await _token_bucket(keys=keys, args=args)
+    return bool(allowed), float(retry_after), int(blocked)
+
+
+async def check_quota(user_id: int):
+    """Take one request from the user's request bucket if the token bucket is also non-empty."""
+    try:
+        allowed, retry_after, blocked = await _take(
+            (f"quota:ai:requests:{user_id}", AI_REQUEST_BURST, AI_REQUESTS_PER_MINUTE, 1, 1),
+            (f"quota:ai:tokens:{user_id}", AI_TOKEN_BURST, AI_TOKENS_PER_MINUTE, 0, 1),
+        )
+    except redis.RedisError as e:
+        # Quotas are a fairness aid; a Redis outage should not take the assistant down with it.
+        return
+    if not allowed:
+        detail = "AI request quota exceeded" if blocked == 1 else "AI token quota exceeded"
+        raise _too_many_requests(detail, retry_after)
+
+
+async def charge_tokens(user_id: int, generated: int):
+    if generated <= 0:
+        return
+    try:
+        await _take((f"quota:ai:tokens:{user_id}", AI_TOKEN_BURST, AI_TOKENS_PER_MINUTE, generated, -1e18))
+    except redis.RedisError as e:
+        pass
+
+
+class FairScheduler:
+    """Hands out model slots round-robin across users instead of in arrival order."""
+
+    def __init__(self, slots: int = 1):
+        self._slots = slots
+        self._active = 0
+        self._queues: "OrderedDict[int, Deque[asyncio.Future]]" = OrderedDict()
+        self._reserved: Dict[int, int] = {}
+
+    def pending(self, user_id: int) -> int:
+        """Admitted generations of this user that do not hold a model slot yet."""
+        return self._reserved.get(user_id, 0)
+
+    def reserve(self, user_id: int) -> "Reservation":
+        self._reserved[user_id] = self._reserved.get(user_id, 0) + 1
+        return Reservation(self, user_id)
+
+    def _unreserve(self, user_id: int):
+        remaining = self._reserved.get(user_id, 0) - 1
+        if remaining > 0:
+            self._reserved[user_id] = remaining
+        else:
+            self._reserved.pop(user_id, None)
+
+    async def acquire(self, user_id: int):
+        if self._active < self._slots and not self._queues:
+            self._active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._discard(user_id, future)
+            raise
+
+    def release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def _discard(self, user_id: int, future: asyncio.Future):
+        queue = self._queues.get(user_id)
+        if queue is None:
+            return
+        if future in queue:
+            queue.remove(future)
+        if not queue:
+            del self._queues[user_id]
+
+    def _dispatch(self):
+        while self._active < self._slots and self._queues:
+            user_id, queue = self._queues.popitem(last=False)
+            future = queue.popleft()
+            if queue:
+                self._queues[user_id] = queue
+            if future.done():
+                continue
+            self._active += 1
+            future.set_result(None)
+
+
+class Reservation:
+    """A user's place in the queue, held from admission until the generation gets a model slot."""
+
+    def __init__(self, scheduler: FairScheduler, user_id: int):
+        self.user_id = user_id
+        # Also runs if the response is dropped before its generator ever starts.
+        self._finalizer = weakref.finalize(self, scheduler._unreserve, user_id)
+
+    def release(self):
+        self._finalizer()
+
+
+scheduler = FairScheduler()
+
+
+async def admit(user_id: int) -> Reservation:
+    """Reject with 429 + Retry-After before any work is done if the user is over quota or already queued up."""
+    if scheduler.pending(user_id) >= AI_MAX_QUEUED_PER_USER:
+        raise _too_many_requests("Too many queued AI requests", AI_QUEUE_RETRY_AFTER)
+    # Reserved before the first await so a concurrent burst cannot all pass the check above.
+    reservation = scheduler.reserve(user_id)
+    try:
+        await check_quota(user_id)
+    except HTTPException:
+        reservation.release()
+        raise
+    return reservation
+
+
+async def run_admitted(reservation: Reservation, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Wait for a fair model slot, stream the generation, then charge the user for what was generated."""
+    user_id = reservation.user_id
+    try:
+        await scheduler.acquire(user_id)
+    finally:
+        reservation.release()
+    generated = 0
+    try:
+        async for token in tokens:
+            generated += 1
+            yield token
+    finally:
+        await tokens.aclose()
+        scheduler.release()
+        try:
+            await charge_tokens(user_id, generated)
+        except Exception as e:
+            pass
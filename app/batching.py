@@ -0,0 +1,164 @@
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+OP_BATCH_WINDOW_MS = int(os.getenv("OP_BATCH_WINDOW_MS", "25"))
+OP_BATCH_MAX_OPS = int(os.getenv("OP_BATCH_MAX_OPS", "256"))
+
+# WebSocket subprotocols a client may offer at connect time; JSON is the fallback when none match.
+SUBPROTOCOLS = {"docqent.json": "json"}
+if msgpack is not None:
+    SUBPROTOCOLS["docqent.msgpack"] = "msgpack"
+
+
+def negotiate_subprotocol(offered: List[str]) -> Optional[str]:
+    """Pick the client's most preferred subprotocol that this server supports."""
+    for name in offered:
+        if name in SUBPROTOCOLS:
+            return name
+    return None
+
+
+def _merge_pair(prev: dict, op: dict) -> Optional[dict]:
+    if prev.get("user_id") != op.get("user_id") or prev["op"] != op["op"]:
+        return None
+    if op["op"] == "insert":
+        if op["position"] == prev["position"] + len(prev["text"]):
+            return {**prev, "text": prev["text"] + op["text"]}
+    elif op["op"] == "delete":
+        prev_length = prev.get("length", 1)
+        length = op.get("length", 1)
+        if op["position"] == prev["position"]:
+            return {**prev, "length": prev_length + length}
+        if op["position"] + length == prev["position"]:
+            return {**prev, "position": op["position"], "length": prev_length + length}
+    return None
+
+
+def coalesce_ops(ops: List[dict]) -> List[dict]:
+    """Merge adjacent inserts/deletes and drop anything superseded by a later sync."""
+    merged: List[dict] = []
+    for op in ops:
+        if op["op"] == "sync":
+            merged = [op]
+            continue
+        if merged:
+            combined = _merge_pair(merged[-1], op)
+            if combined is not None:
+                merged[-1] = combined
+                continue
+        merged.append(op)
+    return merged
+
+
+def build_frame(ops: List[dict]) -> dict:
+    if len(ops) == 1:
+        return ops[0]
+    return {"op": "batch", "ops": ops}
+
+
+def _is_valid_op(op) -> bool:
+    if not isinstance(op, dict):
+        return False
+    if op.get("op") == "sync":
+        return True
+    if op.get("op") == "presence":
+        return isinstance(op.get("state"), dict)
+    if not isinstance(op.get("position"), int):
+        return False
+    if op.get("op") == "insert":
+        return isinstance(op.get("text"), str)
+    if op.get("op") == "delete":
+        length = op.get("length", 1)
+        return isinstance(length, int) and length >= 0
+    return False
+
+
+def frame_ops(frame) -> List[dict]:
+    """Flatten a single-op or batch frame into a list of well-formed ops."""
+    if not isinstance(frame, dict):
+        return []
+    if frame.get("op") == "batch":
+        items = frame.get("ops") or []
+    else:
+        items = [frame]
+    return [op for op in items if _is_valid_op(op)]
+
+
+def encode_frame(frame: dict, encoding: str) -> Union[str, bytes]:
+    if encoding == "msgpack":
+        return msgpack.packb(frame, use_bin_type=True)
+    return json.dumps(frame)
+
+
+def encoded_channel(channel: str, encoding: str) -> str:
+    """Redis channel carrying a channel's frames already encoded for one subprotocol."""
+    return channel if encoding == "json" else f"{channel}:{encoding}"
+
+
+async def publish_frame(redis_client, channel: str, frame: dict):
+    """Encode a frame once per supported encoding so subscribers forward it without re-encoding."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for encoding in set(SUBPROTOCOLS.values()):
+            pipe.publish(encoded_channel(channel, encoding), encode_frame(frame, encoding))
+        await pipe.execute()
+
+
+def decode_frame(data: Union[str, bytes]) -> List[dict]:
+    try:
+        if isinstance(data, (bytes, bytearray)):
+            if msgpack is None:
+                return []
+            frame = msgpack.unpackb(data, raw=False)
+        else:
+            frame = json.loads(data)
+    except Exception as e:
+        return []
+    return frame_ops(frame)
+
+
+class OpBatcher:
+    """Collects ops arriving within a short window and hands them off as one coalesced batch."""
+
+    def __init__(
+        self,
+        on_flush: Callable[[List[dict]], Awaitable[None]],
+        window_ms: int = OP_BATCH_WINDOW_MS,
+        max_ops: int = OP_BATCH_MAX_OPS,
+    ):
+        self._on_flush = on_flush
+        self._window = window_ms / 1000
+        self._max_ops = max_ops
+        self._pending: List[dict] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, op: dict):
+        self._pending.append(op)
+        if len(self._pending) >= self._max_ops:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            ops, self._pending = coalesce_ops(self._pending), []
+            if ops:
+                await self._on_flush(ops)
+
+    async def close(self):
+        await self.flush()
@@ -1,12 +1,12 @@
 import hashlib
 import hmac
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from model.Collaboration import Collaboration
 from model.Document import Document
 from model.User import User
 from passlib.context import CryptContext
-from sqlalchemy import select
+from sqlalchemy import delete, insert, or_, select, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -78,6 +78,26 @@ async def delete_document(db: AsyncSession, document_id: int):
         await db.delete(doc)
         await db.commit()
 
+async def create_documents_bulk(db: AsyncSession, documents: List[dict], owner_id: int):
+    if not documents:
+        return
+    await db.execute(
+        insert(Document),
+        [{"title": doc["title"], "content": doc["content"], "owner_id": owner_id} for doc in documents],
+    )
+    await db.commit()
+
+async def stream_accessible_documents(db: AsyncSession, user_id: int, batch_size: int = 500):
+    shared_ids = select(Collaboration.document_id).where(Collaboration.user_id == user_id)
+    result = await db.stream(
+        select(Document.id, Document.title, Document.content, Document.owner_id, Document.created_at)
+        .where(or_(Document.owner_id == user_id, Document.id.in_(shared_ids)))
+        .order_by(Document.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async for rows in result.partitions():
+        yield rows
+
 async def check_document_access(db: AsyncSession, document_id: int, user_id: int) -> Optional[Document]:
     doc = await get_document(db, document_id)
     if not doc:
@@ -92,3 +112,84 @@ async def check_document_access(db: AsyncSession, document_id: int, user_id: int
     )
     collab = result.scalars().first()
     return doc if collab else None
+
+
+async def get_document_collaborators(db: AsyncSession, document_id: int):
+    result = await db.execute(
+        select(Collaboration, User)
+        .join(User, User.id == Collaboration.user_id)
+        .where(Collaboration.document_id == document_id)
+        .order_by(Collaboration.created_at)
+    )
+    return result.all()
+
+async def _partition_pairs(db: AsyncSession, pairs: List[Tuple[int, int]], owner_id: int):
+    document_ids = {document_id for document_id, _ in pairs}
+    result = await db.execute(
+        select(Document.id).where(Document.id.in_(document_ids), Document.owner_id == owner_id)
+    )
+    owned_ids = set(result.scalars().all())
+    owned_pairs = [pair for pair in pairs if pair[0] in owned_ids]
+    existing = set()
+    if owned_pairs:
+        result = await db.execute(
+            select(Collaboration.document_id, Collaboration.user_id).where(
+                tuple_(Collaboration.document_id, Collaboration.user_id).in_(owned_pairs)
+            )
+        )
+        existing = {tuple(row) for row in result.all()}
+    return owned_ids, existing
+
+async def add_collaborators_bulk(db: AsyncSession, pairs: List[Tuple[int, int]], owner_id: int) -> List[dict]:
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return []
+    owned_ids, existing = await _partition_pairs(db, pairs, owner_id)
+    result = await db.execute(select(User.id).where(User.id.in_({user_id for _, user_id in pairs})))
+    user_ids = set(result.scalars().all())
+
+    results = []
+    new_pairs = []
+    for document_id, user_id in pairs:
+        if document_id not in owned_ids:
+            status = "forbidden"
+        elif user_id not in user_ids:
+            status = "user_not_found"
+        elif user_id == owner_id:
+            status = "owner"
+        elif (document_id, user_id) in existing:
+            status = "already_collaborator"
+        else:
+            status = "added"
+            new_pairs.append({"document_id": document_id, "user_id": user_id})
+        results.append({"document_id": document_id, "collaborator_id": user_id, "status": status})
+
+    if new_pairs:
+        await db.execute(insert(Collaboration).prefix_with("IGNORE"), new_pairs)
+        await db.commit()
+    return results
+
+async def remove_collaborators_bulk(db: AsyncSession, pairs: List[Tuple[int, int]], owner_id: int) -> List[dict]:
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return []
+    owned_ids, existing = await _partition_pairs(db, pairs, owner_id)
+
+    results = []
+    for document_id, user_id in pairs:
+        if document_id not in owned_ids:
+            status = "forbidden"
+        elif (document_id, user_id) in existing:
+            status = "removed"
+        else:
+            status = "not_found"
+        results.append({"document_id": document_id, "collaborator_id": user_id, "status": status})
+
+    if existing:
+        await db.execute(
+            delete(Collaboration).where(
+                tuple_(Collaboration.document_id, Collaboration.user_id).in_(list(existing))
+            )
+        )
+        await db.commit()
+    return results
@@ -1,49 +1,39 @@
 import os
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
-import json 
+import subprocess
+import sys
 import unsloth
 import torch 
 from unsloth import FastLanguageModel 
 from trl import SFTTrainer 
 from transformers import TrainingArguments 
-from datasets import Dataset 
+from packing import (PackedDataCollator, check_packing_support, pack_dataset,
+                     padding_report)
+from prepare_dataset import load_prepared_dataset
 
 
-with open("/home/shorouk/Documents/shorouk/project/doc2dial_v1.0.1/doc2dial_doc.json", "r") as f:
-    docs = json.load(f)["doc_data"]
-with open("/home/shorouk/Documents/shorouk/project/doc2dial_v1.0.1/doc2dial_dial_train.json", "r") as f:
-    dials = json.load(f)["dial_data"]
-
-doc_map = {}
-for domain in docs.values():
-    for doc_id, content in domain.items():
-        doc_map[doc_id] = content["doc_text"]
-
-formatted_data = []
-
-for domain in dials.values(): 
-    for doc_id, dialogues in domain.items():
-        full_text = doc_map.get(doc_id, "")
-        
-        for dial in dialogues:
-            turns = dial["turns"]
-            for i in range(len(turns) - 1):
-                if turns[i]["role"] == "user" and turns[i+1]["role"] == "agent":
-
-                    context_snippet = full_text[:2000] 
-                    
-                    formatted_data.append({
-                        "instruction": "You are a helpful assistant. Answer the question using ONLY the provided context.",
-                        "input": f"CONTEXT:\n{context_snippet}\n\nUSER QUESTION:\n{turns[i]['utterance']}",
-                        "output": turns[i+1]["utterance"]
-                    })
+DOC2DIAL_DIR = "/home/shorouk/Documents/shorouk/project/doc2dial_v1.0.1"
+model_name = "unsloth/granite-4.0-h-micro"
 
-dataset = Dataset.from_list(formatted_data).shuffle(seed=3407)
+# Dataset preparation runs as its own CPU-only step (see prepare_dataset.py); a cache hit only rehashes the inputs.
+prepared_dir = subprocess.run(
+    [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "prepare_dataset.py"),
+        "--docs", os.path.join(DOC2DIAL_DIR, "doc2dial_doc.json"),
+        "--dials", os.path.join(DOC2DIAL_DIR, "doc2dial_dial_train.json"),
+        "--tokenizer", model_name,
+    ],
+    # Only stdout (the output directory) is captured; progress, warnings and errors stay on stderr.
+    check=True, stdout=subprocess.PIPE, text=True,
+).stdout.strip().splitlines()[-1]
+
+dataset = load_prepared_dataset(prepared_dir).shuffle(seed=3407)
 dataset = dataset.select(range(min(len(dataset), 5000))) 
 
 
-model_name = "unsloth/granite-4.0-h-micro"
 max_seq_length = 4096 
+per_device_train_batch_size = 2
+packing = os.getenv("FINETUNE_PACKING", "0") == "1"
 
 model, tokenizer = FastLanguageModel.from_pretrained(
     model_name = model_name,
@@ -63,19 +53,12 @@ model = FastLanguageModel.get_peft_model(
     random_state = 3407,
 )
 
-def format_prompt(examples):
-    texts = [] 
-
-    for inst, inp, out in zip(examples["instruction"], examples["input"], examples["output"]):
-        messages = [
-            {"role": "system", "content": inst},
-            {"role": "user", "content": inp},
-            {"role": "assistant", "content": out}
-        ] 
-        texts.append(tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False))
-    return { "text" : texts }
-
-dataset = dataset.map(format_prompt, batched = True)
+if packing:
+    # Refuses setups (no flash attention, no Mamba kernels) where packed examples would see each other.
+    check_packing_support(model)
+    model.config.use_cache = False
+    dataset = pack_dataset(dataset, max_seq_length)
+print(padding_report(dataset["length"], per_device_train_batch_size, "packed" if packing else "bucketed"))
 
 trainer = SFTTrainer(
     model = model,
@@ -83,8 +66,10 @@ trainer = SFTTrainer(
     train_dataset = dataset,
     dataset_text_field = "text",
     max_seq_length = max_seq_length,
+    dataset_kwargs = {"skip_prepare_dataset": True},
+    data_collator = PackedDataCollator() if packing else None,
     args = TrainingArguments(
-        per_device_train_batch_size = 2, 
+        per_device_train_batch_size = per_device_train_batch_size, 
         gradient_accumulation_steps = 4, 
         warmup_steps = 10,
         max_steps = 150, 
@@ -97,6 +82,9 @@ trainer = SFTTrainer(
         lr_scheduler_type = "linear",
         seed = 3407,
         output_dir = "outputs",
+        group_by_length = not packing,
+        length_column_name = "length",
+        remove_unused_columns = not packing,
     ),
 )
 
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import uuid
+from typing import AsyncIterator, Dict, Optional
+
+from admission import redis_client
+
+AI_JOB_TTL_SECONDS = int(os.getenv("AI_JOB_TTL_SECONDS", "600"))
+
+# Jobs started by this worker, so a cancel that lands here skips the pub/sub round trip.
+_local_jobs: Dict[str, asyncio.Task] = {}
+
+
+def _meta_key(job_id: str) -> str:
+    return f"aijob:{job_id}"
+
+
+def _tokens_key(job_id: str) -> str:
+    # Token i is stored under stream id "{i + 1}-0", so reading after "{offset}-0" resumes at token `offset`.
+    return f"aijob:{job_id}:tokens"
+
+
+def _cancel_channel(job_id: str) -> str:
+    return f"aijob:{job_id}:cancel"
+
+
+async def start_job(user_id: int, tokens: AsyncIterator[str]) -> str:
+    job_id = uuid.uuid4().hex
+    await redis_client.hset(_meta_key(job_id), mapping={"user_id": user_id, "status": "running", "tokens": 0})
+    await redis_client.expire(_meta_key(job_id), AI_JOB_TTL_SECONDS)
+    task = asyncio.create_task(_run_job(job_id, tokens))
+    _local_jobs[job_id] = task
+    task.add_done_callback(lambda _: _local_jobs.pop(job_id, None))
+    return job_id
+
+
+async def _run_job(job_id: str, tokens: AsyncIterator[str]):
+    watcher = asyncio.create_task(_watch_cancel(job_id, asyncio.current_task()))
+    keep_alive = asyncio.create_task(_keep_alive(job_id))
+    offset = 0
+    status = "done"
+    try:
+        async for token in tokens:
+            offset += 1
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.xadd(_tokens_key(job_id), {"text": token}, id=f"{offset}-0")
+                if offset == 1:
+                    pipe.expire(_tokens_key(job_id), AI_JOB_TTL_SECONDS)
+                await pipe.execute()
+    except asyncio.CancelledError:
+        status = "cancelled"
+    except Exception as e:
+        status = "error"
+    finally:
+        watcher.cancel()
+        keep_alive.cancel()
+        await tokens.aclose()
+        try:
+            await redis_client.xadd(_tokens_key(job_id), {"status": status}, id=f"{offset + 1}-0")
+            await redis_client.hset(_meta_key(job_id), mapping={"status": status, "tokens": offset})
+            await redis_client.expire(_tokens_key(job_id), AI_JOB_TTL_SECONDS)
+            await redis_client.expire(_meta_key(job_id), AI_JOB_TTL_SECONDS)
+        except Exception as e:
+            pass
+
+
+async def _keep_alive(job_id: str):
+    """Keep a running job's keys alive however long it queues or decodes; the TTL counts from when it ends."""
+    while True:
+        await asyncio.sleep(AI_JOB_TTL_SECONDS / 3)
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.expire(_meta_key(job_id), AI_JOB_TTL_SECONDS)
+                pipe.expire(_tokens_key(job_id), AI_JOB_TTL_SECONDS)
+                await pipe.execute()
+        except Exception as e:
+            pass
+
+
+async def _watch_cancel(job_id: str, task: asyncio.Task):
+    pubsub = redis_client.pubsub()
+    try:
+        await pubsub.subscribe(_cancel_channel(job_id))
+        async for message in pubsub.listen():
+            if message and message["type"] == "message":
+                task.cancel()
+                return
+    except Exception as e:
+        pass
+    finally:
+        await pubsub.close()
+
+
+async def get_job(job_id: str) -> Optional[dict]:
+    meta = await redis_client.hgetall(_meta_key(job_id))
+    if not meta:
+        return None
+    tokens = int(meta["tokens"])
+    if meta["status"] == "running":
+        tokens = await redis_client.xlen(_tokens_key(job_id))
+    return {"job_id": job_id, "user_id": int(meta["user_id"]), "status": meta["status"], "tokens": tokens}
+
+
+async def cancel_job(job_id: str):
+    task = _local_jobs.get(job_id)
+    if task is not None:
+        task.cancel()
+    else:
+        await redis_client.publish(_cancel_channel(job_id), "cancel")
+
+
+async def read_job(job_id: str, offset: int = 0) -> AsyncIterator[dict]:
+    """Yield {"offset", "text"} for every token from `offset` on, following the job until it finishes."""
+    last_id = f"{offset}-0"
+    while True:
+        response = await redis_client.xread({_tokens_key(job_id): last_id}, count=256, block=15000)
+        if not response:
+            if not await redis_client.exists(_meta_key(job_id)):
+                yield {"status": "expired"}
+                return
+            continue
+        for entry_id, fields in response[0][1]:
+            last_id = entry_id
+            if "status" in fields:
+                yield {"status": fields["status"]}
+                return
+            yield {"offset": int(entry_id.split("-")[0]), "text": fields["text"]}
@@ -0,0 +1,205 @@
+"""Sequence packing and padding accounting for finetune.py.
+
+Running this module benchmarks plain, length-bucketed and packed batching on
+a prepared dataset with a tiny randomly initialised Llama on CPU:
+
+    python packing.py --prepared prepared_datasets/<hash> --max-seq-length 1024
+"""
+import argparse
+import importlib.util
+import random
+import time
+from typing import Dict, List
+
+import torch
+
+
+def pack_lengths(lengths: List[int], max_seq_length: int) -> List[List[int]]:
+    """First-fit-decreasing bin packing of example indices into sequences of at most max_seq_length tokens."""
+    order = sorted((i for i, length in enumerate(lengths) if length <= max_seq_length),
+                   key=lambda i: lengths[i], reverse=True)
+    bins: List[List[int]] = []
+    free: List[int] = []
+    for i in order:
+        for b, space in enumerate(free):
+            if lengths[i] <= space:
+                bins[b].append(i)
+                free[b] -= lengths[i]
+                break
+        else:
+            bins.append([i])
+            free.append(max_seq_length - lengths[i])
+    return bins
+
+
+def pack_dataset(dataset, max_seq_length: int, seed: int = 3407):
+    """Concatenate tokenized examples into packed rows, recording the length of each packed example."""
+    from datasets import Dataset
+
+    lengths = dataset["length"]
+    all_input_ids = dataset["input_ids"]
+    bins = pack_lengths(lengths, max_seq_length)
+    random.Random(seed).shuffle(bins)
+
+    def rows():
+        for indices in bins:
+            input_ids: List[int] = []
+            for i in indices:
+                input_ids.extend(all_input_ids[i])
+            seq_lengths = [lengths[i] for i in indices]
+            yield {"input_ids": input_ids, "seq_lengths": seq_lengths, "length": len(input_ids)}
+
+    return Dataset.from_generator(rows)
+
+
+class PackedDataCollator:
+    """Flattens packed rows into one padding-free sequence carrying the boundary of every packed example.
+
+    Position ids restart at each example, cu_seq_lens_* keep flash attention inside each example, and
+    seq_idx resets the Mamba state between examples in the mamba_ssm/causal_conv1d kernels. The first
+    token of each example is never predicted from the one before it.
+    """
+
+    def __init__(self):
+        from transformers import DataCollatorWithFlattening
+
+        self._flatten = DataCollatorWithFlattening(return_flash_attn_kwargs=True, return_seq_idx=True)
+
+    def __call__(self, features: List[dict]) -> Dict[str, torch.Tensor]:
+        examples = []
+        for feature in features:
+            start = 0
+            for length in feature["seq_lengths"]:
+                examples.append({"input_ids": feature["input_ids"][start:start + length]})
+                start += length
+        return self._flatten(examples)
+
+
+def check_packing_support(model):
+    """Raise ValueError unless every layer of the model keeps packed examples apart.
+
+    Only flash attention splits attention on cu_seq_lens, and Mamba layers only honour seq_idx with the
+    mamba_ssm and causal_conv1d kernels; the PyTorch fallbacks drop it and carry the recurrent state
+    from one packed example into the next.
+    """
+    config = model.config
+    attn_implementation = getattr(config, "_attn_implementation", None) or ""
+    if "flash" not in attn_implementation:
+        raise ValueError(f"Packing needs flash attention to keep examples apart, but the model uses {attn_implementation!r}")
+    layer_types = getattr(config, "layers_block_type", None) or getattr(config, "layer_types", None) or []
+    if any(layer_type in ("mamba", "linear_attention") for layer_type in layer_types):
+        missing = [package for package in ("mamba_ssm", "causal_conv1d") if importlib.util.find_spec(package) is None]
+        if missing:
+            raise ValueError(
+                f"Packing a hybrid Mamba model needs {' and '.join(missing)}; without them the SSM state "
+                "leaks across packed examples"
+            )
+
+
+class PaddedDataCollator:
+    """Right-pads unpacked tokenized examples; used for the baseline and length-bucketed modes."""
+
+    def __init__(self, pad_token_id: int):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features: List[dict]) -> Dict[str, torch.Tensor]:
+        width = max(feature["length"] for feature in features)
+        input_ids = torch.full((len(features), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), width), dtype=torch.long)
+        for row, feature in enumerate(features):
+            input_ids[row, :feature["length"]] = torch.tensor(feature["input_ids"], dtype=torch.long)
+            attention_mask[row, :feature["length"]] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, -100)
+        return {"input_ids": input_ids, "labels": labels, "attention_mask": attention_mask}
+
+
+def batch_order(lengths: List[int], batch_size: int, mode: str, seed: int = 3407) -> List[List[int]]:
+    """Index batches as the trainer would draw them: random order, or length-grouped like group_by_length."""
+    if mode == "bucketed":
+        from transformers.trainer_pt_utils import LengthGroupedSampler
+
+        generator = torch.Generator().manual_seed(seed)
+        indices = list(LengthGroupedSampler(batch_size, lengths=lengths, generator=generator))
+    else:
+        indices = list(range(len(lengths)))
+        random.Random(seed).shuffle(indices)
+    return [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+
+def padding_report(lengths: List[int], batch_size: int, mode: str, seed: int = 3407) -> Dict[str, float]:
+    """Padding ratio and real tokens per optimizer step for one pass over the data."""
+    batches = batch_order(lengths, batch_size, mode, seed)
+    real = sum(lengths)
+    if mode == "packed":
+        # Packed batches are flattened into one sequence, so there is no padding at all.
+        padded = real
+    else:
+        padded = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    return {
+        "mode": mode,
+        "steps": len(batches),
+        "padding_ratio": round(1 - real / padded, 4) if padded else 0.0,
+        "tokens_per_step": round(real / len(batches), 1) if batches else 0.0,
+    }
+
+
+def _benchmark(dataset, collator, batches: List[List[int]], vocab_size: int, steps: int) -> Dict[str, float]:
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=128, intermediate_size=256, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=8192)
+    config._attn_implementation = "sdpa"
+    # Without a cache, SDPA masks packed examples apart from the restarted position ids.
+    config.use_cache = False
+    model = LlamaForCausalLM(config)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+
+    real_tokens = 0
+    started = time.perf_counter()
+    for batch in batches[:steps]:
+        features = [dataset[i] for i in batch]
+        inputs = collator(features)
+        real_tokens += sum(feature["length"] for feature in features)
+        loss = model(**inputs).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    elapsed = time.perf_counter() - started
+    return {"tokens_per_second": round(real_tokens / elapsed, 1), "seconds": round(elapsed, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare padding and CPU throughput of plain, bucketed and packed batching")
+    parser.add_argument("--prepared", required=True, help="directory written by prepare_dataset.py")
+    parser.add_argument("--max-seq-length", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=20, help="training steps per mode for the throughput run; 0 skips it")
+    parser.add_argument("--limit", type=int, default=2000, help="examples to use")
+    args = parser.parse_args()
+
+    from prepare_dataset import load_prepared_dataset
+
+    dataset = load_prepared_dataset(args.prepared).shuffle(seed=3407)
+    dataset = dataset.select(range(min(len(dataset), args.limit)))
+    dataset = dataset.filter(lambda example: example["length"] <= args.max_seq_length)
+    lengths = dataset["length"]
+    packed = pack_dataset(dataset, args.max_seq_length)
+    vocab_size = max(max(ids) for ids in dataset["input_ids"]) + 1
+    pad_token_id = 0
+
+    modes = [
+        ("plain", dataset, lengths, PaddedDataCollator(pad_token_id)),
+        ("bucketed", dataset, lengths, PaddedDataCollator(pad_token_id)),
+        ("packed", packed, packed["length"], PackedDataCollator()),
+    ]
+    for mode, data, data_lengths, collator in modes:
+        report = padding_report(data_lengths, args.batch_size, mode)
+        if args.steps:
+            batches = batch_order(data_lengths, args.batch_size, mode)
+            report.update(_benchmark(data, collator, batches, vocab_size, args.steps))
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
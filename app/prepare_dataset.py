@@ -0,0 +1,263 @@
+"""Offline doc2dial preparation for finetune.py.
+
+Streams the doc2dial JSON files, grounds every user/agent turn pair in the
+document sections the agent turn references, applies the chat template and
+tokenizes in a CPU process pool, and writes memory-mappable Arrow shards into
+a directory keyed by a hash of the inputs and settings. Re-running with the
+same inputs returns the cached directory without doing any work.
+
+    python prepare_dataset.py --docs doc2dial_doc.json --dials doc2dial_dial_train.json
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+PREP_VERSION = 1
+DEFAULT_TOKENIZER = "unsloth/granite-4.0-h-micro"
+DEFAULT_CACHE_DIR = "prepared_datasets"
+INSTRUCTION = "You are a helpful assistant. Answer the question using ONLY the provided context."
+
+SCHEMA = pa.schema([
+    ("text", pa.string()),
+    ("input_ids", pa.list_(pa.int32())),
+    ("attention_mask", pa.list_(pa.int8())),
+    ("length", pa.int32()),
+])
+
+
+def iter_nested(path: str, root: str) -> Iterator[Tuple[str, str, object]]:
+    """Yield (domain, key, value) for a doc2dial file shaped {root: {domain: {key: value}}}."""
+    if ijson is None:
+        with open(path, "r") as f:
+            for domain, entries in json.load(f)[root].items():
+                for key, value in entries.items():
+                    yield domain, key, value
+        return
+
+    with open(path, "rb") as f:
+        depth = 0
+        in_root = False
+        domain = key = builder = None
+        builder_depth = 0
+        for _, event, value in ijson.parse(f):
+            if builder is not None:
+                builder.event(event, value)
+                if event in ("start_map", "start_array"):
+                    builder_depth += 1
+                elif event in ("end_map", "end_array"):
+                    builder_depth -= 1
+                if builder_depth == 0:
+                    yield domain, key, builder.value
+                    builder = None
+                continue
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            elif event == "map_key":
+                if depth == 1:
+                    in_root = value == root
+                elif depth == 2 and in_root:
+                    domain = value
+                elif depth == 3 and in_root:
+                    key = value
+                    builder = ijson.ObjectBuilder()
+                    builder_depth = 0
+
+
+def load_documents(path: str) -> dict:
+    """Keep only what grounding needs: the text and each span's section text."""
+    documents = {}
+    for _, doc_id, doc in iter_nested(path, "doc_data"):
+        spans = {
+            sp_id: (span.get("id_sec"), span.get("start_sec", 0), span.get("text_sec", ""))
+            for sp_id, span in doc.get("spans", {}).items()
+        }
+        documents[doc_id] = (doc.get("doc_text", ""), spans)
+    return documents
+
+
+def grounding_passage(document: Optional[tuple], references: List[dict], max_chars: int) -> str:
+    """Sections referenced by the agent turn, in document order, falling back to the document head."""
+    if document is None:
+        return ""
+    doc_text, spans = document
+    sections = {}
+    for reference in references:
+        span = spans.get(reference.get("sp_id"))
+        if span is not None:
+            sections.setdefault(span[0], (span[1], span[2]))
+    if not sections:
+        return doc_text[:max_chars]
+    passage = "\n".join(text.strip() for _, text in sorted(sections.values()))
+    return passage[:max_chars]
+
+
+def build_examples(document: Optional[tuple], dialogues: List[dict], max_chars: int) -> List[dict]:
+    examples = []
+    for dial in dialogues:
+        turns = dial["turns"]
+        for i in range(len(turns) - 1):
+            if turns[i]["role"] == "user" and turns[i + 1]["role"] == "agent":
+                context = grounding_passage(document, turns[i + 1].get("references", []), max_chars)
+                examples.append({
+                    "instruction": INSTRUCTION,
+                    "input": f"CONTEXT:\n{context}\n\nUSER QUESTION:\n{turns[i]['utterance']}",
+                    "output": turns[i + 1]["utterance"],
+                })
+    return examples
+
+
+_tokenizer = None
+
+
+def _init_worker(tokenizer_name: str):
+    global _tokenizer
+    from transformers import AutoTokenizer
+    _tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def _tokenize_group(task: Tuple[Optional[tuple], List[dict], int]) -> List[dict]:
+    document, dialogues, max_chars = task
+    rows = []
+    for example in build_examples(document, dialogues, max_chars):
+        messages = [
+            {"role": "system", "content": example["instruction"]},
+            {"role": "user", "content": example["input"]},
+            {"role": "assistant", "content": example["output"]},
+        ]
+        text = _tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+        input_ids = _tokenizer(text, add_special_tokens=False)["input_ids"]
+        rows.append({
+            "text": text,
+            "input_ids": input_ids,
+            "attention_mask": [1] * len(input_ids),
+            "length": len(input_ids),
+        })
+    return rows
+
+
+def cache_key(docs_path: str, dials_path: str, tokenizer_name: str, max_chars: int) -> str:
+    digest = hashlib.sha256()
+    for path in (docs_path, dials_path):
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    digest.update(json.dumps([tokenizer_name, max_chars, PREP_VERSION]).encode())
+    return digest.hexdigest()[:16]
+
+
+class _ShardWriter:
+    def __init__(self, out_dir: str, shard_size: int):
+        self._out_dir = out_dir
+        self._shard_size = shard_size
+        self._rows: List[dict] = []
+        self.shards: List[str] = []
+        self.num_rows = 0
+
+    def add(self, rows: List[dict]):
+        self._rows.extend(rows)
+        while len(self._rows) >= self._shard_size:
+            self._write(self._rows[:self._shard_size])
+            self._rows = self._rows[self._shard_size:]
+
+    def close(self):
+        if self._rows:
+            self._write(self._rows)
+            self._rows = []
+
+    def _write(self, rows: List[dict]):
+        name = f"shard-{len(self.shards):05d}.arrow"
+        table = pa.Table.from_pylist(rows, schema=SCHEMA)
+        with pa.OSFile(os.path.join(self._out_dir, name), "wb") as sink:
+            with pa.ipc.new_stream(sink, SCHEMA) as writer:
+                writer.write_table(table)
+        self.shards.append(name)
+        self.num_rows += len(rows)
+
+
+def prepare_dataset(
+    docs_path: str,
+    dials_path: str,
+    tokenizer_name: str = DEFAULT_TOKENIZER,
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    max_chars: int = 2000,
+    workers: Optional[int] = None,
+    shard_size: int = 5000,
+) -> str:
+    """Return the directory holding the prepared shards, building it only on a cache miss."""
+    out_dir = os.path.join(cache_dir, cache_key(docs_path, dials_path, tokenizer_name, max_chars))
+    if os.path.exists(os.path.join(out_dir, "manifest.json")):
+        return out_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        documents = load_documents(docs_path)
+        tasks = (
+            (documents.get(doc_id), dialogues, max_chars)
+            for _, doc_id, dialogues in iter_nested(dials_path, "dial_data")
+        )
+        writer = _ShardWriter(tmp_dir, shard_size)
+        # spawn keeps workers free of any CUDA state the parent (finetune.py) may have initialised.
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers or os.cpu_count(), initializer=_init_worker, initargs=(tokenizer_name,)) as pool:
+            for rows in pool.imap(_tokenize_group, tasks, chunksize=4):
+                writer.add(rows)
+        writer.close()
+
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump({
+                "version": PREP_VERSION,
+                "tokenizer": tokenizer_name,
+                "max_chars": max_chars,
+                "num_rows": writer.num_rows,
+                "shards": writer.shards,
+            }, f, indent=2)
+        os.replace(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return out_dir
+
+
+def load_prepared_dataset(out_dir: str):
+    """Memory-map the prepared shards as a single datasets.Dataset."""
+    from datasets import Dataset, concatenate_datasets
+
+    with open(os.path.join(out_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    return concatenate_datasets([Dataset.from_file(os.path.join(out_dir, name)) for name in manifest["shards"]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare tokenized doc2dial shards for finetune.py")
+    parser.add_argument("--docs", required=True, help="doc2dial_doc.json")
+    parser.add_argument("--dials", required=True, help="doc2dial_dial_train.json")
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--max-chars", type=int, default=2000, help="context budget per example")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--shard-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    out_dir = prepare_dataset(
+        args.docs, args.dials, args.tokenizer, args.cache_dir, args.max_chars, args.workers, args.shard_size
+    )
+    print(out_dir)
+
+
+if __name__ == "__main__":
+    main()
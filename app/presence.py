@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+from batching import publish_frame
+
+PRESENCE_MAX_HZ = float(os.getenv("PRESENCE_MAX_HZ", "10"))
+PRESENCE_TTL_SECONDS = int(os.getenv("PRESENCE_TTL_SECONDS", "30"))
+
+# Drops one of the user's connections; on the last one, forgets their presence. Returns the remaining count.
+_RELEASE = """
+local remaining = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if remaining <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+return remaining
+"""
+
+
+def presence_channel(document_id: int) -> str:
+    return f"presence:{document_id}"
+
+
+def presence_states_key(document_id: int) -> str:
+    # user_id -> latest presence frame
+    return f"presence:{document_id}:states"
+
+
+def presence_seen_key(document_id: int) -> str:
+    # user_id scored by the time their presence expires
+    return f"presence:{document_id}:seen"
+
+
+def presence_connections_key(document_id: int) -> str:
+    # user_id -> open sockets on this document, across workers
+    return f"presence:{document_id}:connections"
+
+
+def presence_gate_key(document_id: int, user_id: int) -> str:
+    return f"presence:{document_id}:{user_id}:gate"
+
+
+async def get_presence_snapshot(redis_client, document_id: int) -> list:
+    """Current presence of everyone on the document, skipping users whose presence has expired."""
+    states_key = presence_states_key(document_id)
+    seen_key = presence_seen_key(document_id)
+    now = time.time()
+    expired = await redis_client.zrangebyscore(seen_key, "-inf", now)
+    if expired:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrem(seen_key, *expired)
+            pipe.hdel(states_key, *expired)
+            await pipe.execute()
+    users = await redis_client.zrangebyscore(seen_key, f"({now}", "+inf")
+    if not users:
+        return []
+    states = await redis_client.hmget(states_key, users)
+    return [json.loads(state) for state in states if state]
+
+
+class PresenceThrottle:
+    """Publishes a user's presence at most PRESENCE_MAX_HZ times a second across all their connections.
+
+    The rate is enforced by a Redis gate key shared by the user's sockets; each socket keeps only its
+    latest state and publishes it once the gate reopens.
+    """
+
+    def __init__(self, redis_client, document_id: int, user_id: int,
+                 max_hz: float = PRESENCE_MAX_HZ, ttl_seconds: int = PRESENCE_TTL_SECONDS):
+        self._redis = redis_client
+        self._channel = presence_channel(document_id)
+        self._states_key = presence_states_key(document_id)
+        self._seen_key = presence_seen_key(document_id)
+        self._connections_key = presence_connections_key(document_id)
+        self._gate_key = presence_gate_key(document_id, user_id)
+        self._user_id = user_id
+        self._interval_ms = int(1000 / max_hz) if max_hz > 0 else 0
+        self._ttl = ttl_seconds
+        self._latest: Optional[dict] = None
+        self._sender: Optional[asyncio.Task] = None
+        self._release = redis_client.register_script(_RELEASE)
+
+    async def open(self):
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.hincrby(self._connections_key, self._user_id, 1)
+                pipe.expire(self._connections_key, self._ttl)
+                await pipe.execute()
+        except Exception as e:
+            pass
+
+    async def update(self, state: dict):
+        self._latest = {"op": "presence", "user_id": self._user_id, "state": state}
+        if self._sender is None:
+            self._sender = asyncio.create_task(self._send())
+
+    async def _send(self):
+        try:
+            while self._latest is not None:
+                wait = await self._wait_for_gate()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                await self._publish()
+        finally:
+            self._sender = None
+
+    async def _wait_for_gate(self) -> float:
+        """Seconds until this user may publish again, taking the slot when it is free now."""
+        if not self._interval_ms:
+            return 0
+        try:
+            if await self._redis.set(self._gate_key, 1, nx=True, px=self._interval_ms):
+                return 0
+            return max(await self._redis.pttl(self._gate_key), 1) / 1000
+        except Exception as e:
+            return 0
+
+    async def _publish(self):
+        message, self._latest = self._latest, None
+        if message is None:
+            return
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.hset(self._states_key, self._user_id, json.dumps(message))
+                pipe.zadd(self._seen_key, {self._user_id: time.time() + self._ttl})
+                pipe.expire(self._states_key, self._ttl)
+                pipe.expire(self._seen_key, self._ttl)
+                await pipe.execute()
+            await publish_frame(self._redis, self._channel, message)
+        except Exception as e:
+            pass
+
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(self._ttl / 2)
+            try:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    pipe.zadd(self._seen_key, {self._user_id: time.time() + self._ttl}, xx=True)
+                    for key in (self._states_key, self._seen_key, self._connections_key):
+                        pipe.expire(key, self._ttl)
+                    await pipe.execute()
+            except Exception as e:
+                pass
+
+    async def close(self):
+        if self._sender is not None:
+            self._sender.cancel()
+            self._sender = None
+        try:
+            remaining = await self._release(
+                keys=[self._connections_key, self._states_key, self._seen_key], args=[self._user_id]
+            )
+            if remaining <= 0:
+                await publish_frame(self._redis, self._channel, {"op": "presence", "user_id": self._user_id, "state": None})
+        except Exception as e:
+            pass
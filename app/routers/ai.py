@@ -1,30 +1,55 @@
 import asyncio
+import json
 import os
+import time
 
+from admission import admit, run_admitted
+from auth import get_current_user
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import StreamingResponse
+from jobs import cancel_job, get_job, read_job, start_job
 from llama_cpp import Llama
+from model.User import User
 from pydantic import BaseModel
+from speculative import (AI_SPECULATIVE_ENDPOINTS, SpeculativeStats,
+                         build_draft_model)
 from tavily import TavilyClient
 
 load_dotenv()
 router = APIRouter()
 
+MODEL_PATH = "/home/shorouk/Documents/shorouk/project/app/granite-4.0-h-micro-Q4_K_M.gguf"
+N_CTX = 8192
+
+draft_model = build_draft_model(MODEL_PATH, n_ctx=N_CTX)
+speculative_stats = SpeculativeStats()
+
 llm = Llama(
-    model_path="/home/shorouk/Documents/shorouk/project/app/granite-4.0-h-micro-Q4_K_M.gguf", 
+    model_path=MODEL_PATH, 
     n_gpu_layers=-1, 
-    n_ctx=8192,
-    logits_all=False 
+    n_ctx=N_CTX,
+    logits_all=False,
+    draft_model=draft_model,
 )
 
+def use_speculative(endpoint: str) -> bool:
+    # The single model instance is only ever used by one generation at a time (see admission.scheduler).
+    speculative = draft_model is not None and endpoint in AI_SPECULATIVE_ENDPOINTS
+    llm.draft_model = draft_model if speculative else None
+    if speculative:
+        draft_model.reset_stats()
+    return speculative
+
 class ChatRequest(BaseModel):
     context: str
     question: str
 
-@router.post("/ask")
-async def ask_assistant(request: ChatRequest):
-    prompt = f"""<|start_of_role|>system<|end_of_role|>You are a precise technical assistant. 
+class JobRequest(ChatRequest):
+    web: bool = False
+
+def local_prompt(request: ChatRequest) -> str:
+    return f"""<|start_of_role|>system<|end_of_role|>You are a precise technical assistant. 
 Use the provided context to answer the question, or internal knowledge. If you don't know, say you don't know. 
 Your goal is to provide structured, factual information.
 
@@ -41,40 +66,43 @@ OUTPUT STYLE RULES:
 <|start_of_role|>user<|end_of_role|>{request.question}<|end_of_text|>
 <|start_of_role|>assistant<|end_of_role|>"""
 
-    async def stream_generator():
-        llm.reset() 
-        
-        try:
-            stream = llm(
-                prompt, 
-                stop=["<|end_of_text|>", "<|end_of_role|>"],
-                stream=True, 
-                max_tokens=1024, 
-                temperature=0.1, 
-                top_p=0.9
-            )
-
-            for chunk in stream:
-                if chunk and "choices" in chunk and len(chunk["choices"]) > 0:
-                    token = chunk["choices"][0].get("text", "")
-                    yield token
-                await asyncio.sleep(0.01)
-        except Exception as e:
-            yield f"\n[Error during generation: {str(e)}]"
-
-    return StreamingResponse(stream_generator(), media_type="text/plain")
-
-@router.post("/ask_web")
-async def ask_assistant_web(request: ChatRequest):
+async def stream_local(prompt: str, endpoint: str = "ask"):
+    llm.reset() 
+    speculative = use_speculative(endpoint)
+    started = time.perf_counter()
+    generated = 0
     
+    try:
+        stream = llm(
+            prompt, 
+            stop=["<|end_of_text|>", "<|end_of_role|>"],
+            stream=True, 
+            max_tokens=1024, 
+            temperature=0.1, 
+            top_p=0.9
+        )
+
+        for chunk in stream:
+            if chunk and "choices" in chunk and len(chunk["choices"]) > 0:
+                token = chunk["choices"][0].get("text", "")
+                generated += 1
+                yield token
+            await asyncio.sleep(0)
+    except Exception as e:
+        yield f"\n[Error during generation: {str(e)}]"
+    finally:
+        speculative_stats.record(endpoint, speculative, generated, time.perf_counter() - started, draft_model)
+
+def tavily_client() -> TavilyClient:
     tavily_key = os.getenv("TavilyClient_api_key")
     if not tavily_key:
         raise HTTPException(status_code=500, detail="Tavily API key not configured")
-    
+    return TavilyClient(api_key=tavily_key)
+
+def web_prompt(request: ChatRequest, tavily: TavilyClient) -> str:
     web_context = ""
     search_response = None
     try:
-        tavily = TavilyClient(api_key=tavily_key)
         search_response = tavily.search(
             query=request.question,
             search_depth="advanced",
@@ -96,7 +124,7 @@ async def ask_assistant_web(request: ChatRequest):
         if urls:
             sources = "\nSOURCES:\n" + "\n".join(urls)
 
-    prompt = f"""<|start_of_role|>system<|end_of_role|>You are a precise technical assistant operating in STRICT WEB-ONLY MODE.
+    return f"""<|start_of_role|>system<|end_of_role|>You are a precise technical assistant operating in STRICT WEB-ONLY MODE.
 Your goal is to provide structured, factual information.
 
 CRITICAL RULES - YOU MUST FOLLOW THESE EXACTLY:
@@ -122,25 +150,97 @@ OUTPUT STYLE RULES:
 <|start_of_role|>user<|end_of_role|>{request.question}<|end_of_text|>
 <|start_of_role|>assistant<|end_of_role|>"""
 
-    async def stream_generator():
+async def stream_web(prompt: str, endpoint: str = "ask_web"):
+    speculative = use_speculative(endpoint)
+    started = time.perf_counter()
+    generated = 0
+    try:
+        llm.reset()
+        stream = llm(
+            prompt, 
+            stop=["<|end_of_text|>", "<|end_of_role|>"],
+            stream=True, 
+            max_tokens=1024, 
+            temperature=0.0,  
+            top_p=0.1,  
+            repeat_penalty=1.2  
+        )
+
+        for chunk in stream:
+            if chunk and "choices" in chunk:
+                generated += 1
+                yield chunk["choices"][0].get("text", "")
+            await asyncio.sleep(0)
+
+    except Exception as e:
+        yield f"\n\n[SYSTEM ERROR]: {str(e)}"
+    finally:
+        speculative_stats.record(endpoint, speculative, generated, time.perf_counter() - started, draft_model)
+
+@router.post("/ask")
+async def ask_assistant(request: ChatRequest, current_user: User = Depends(get_current_user)):
+    reservation = await admit(current_user.id)
+    prompt = local_prompt(request)
+    return StreamingResponse(run_admitted(reservation, stream_local(prompt)), media_type="text/plain")
+
+@router.post("/ask_web")
+async def ask_assistant_web(request: ChatRequest, current_user: User = Depends(get_current_user)):
+    # Configuration errors surface before the request is charged against the user's quota.
+    tavily = tavily_client()
+    reservation = await admit(current_user.id)
+    try:
+        prompt = web_prompt(request, tavily)
+    except HTTPException:
+        reservation.release()
+        raise
+    return StreamingResponse(run_admitted(reservation, stream_web(prompt)), media_type="text/plain")
+
+@router.post("/jobs")
+async def submit_job(request: JobRequest, current_user: User = Depends(get_current_user)):
+    """Start a generation that keeps running server-side; attach to it with /jobs/{job_id}/stream."""
+    tavily = tavily_client() if request.web else None
+    reservation = await admit(current_user.id)
+    if request.web:
         try:
-            llm.reset()
-            stream = llm(
-                prompt, 
-                stop=["<|end_of_text|>", "<|end_of_role|>"],
-                stream=True, 
-                max_tokens=1024, 
-                temperature=0.0,  
-                top_p=0.1,  
-                repeat_penalty=1.2  
-            )
-
-            for chunk in stream:
-                if chunk and "choices" in chunk:
-                    yield chunk["choices"][0].get("text", "")
-                await asyncio.sleep(0.01)
-
-        except Exception as e:
-            yield f"\n\n[SYSTEM ERROR]: {str(e)}"
-
-    return StreamingResponse(stream_generator(), media_type="text/plain")
+            tokens = stream_web(web_prompt(request, tavily), endpoint="jobs")
+        except HTTPException:
+            reservation.release()
+            raise
+    else:
+        tokens = stream_local(local_prompt(request), endpoint="jobs")
+    job_id = await start_job(current_user.id, run_admitted(reservation, tokens))
+    return {"job_id": job_id}
+
+async def get_owned_job(job_id: str, current_user: User) -> dict:
+    job = await get_job(job_id)
+    if not job or job["user_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str, current_user: User = Depends(get_current_user)):
+    return await get_owned_job(job_id, current_user)
+
+@router.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, offset: int = 0, current_user: User = Depends(get_current_user)):
+    """NDJSON of {"offset", "text"} per token from `offset` on, ending with {"status"}; reattach with the last offset seen."""
+    await get_owned_job(job_id, current_user)
+
+    async def stream_generator():
+        async for event in read_job(job_id, offset):
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(stream_generator(), media_type="application/x-ndjson")
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job_endpoint(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await get_owned_job(job_id, current_user)
+    if job["status"] != "running":
+        return {"message": f"Job already {job['status']}", "job_id": job_id, "status": job["status"]}
+    await cancel_job(job_id)
+    return {"message": "Job cancellation requested", "job_id": job_id, "status": "cancelling"}
+
+@router.get("/speculative/stats")
+async def speculative_stats_endpoint(current_user: User = Depends(get_current_user)):
+    """Decode throughput and draft acceptance since startup, per endpoint and decoding path."""
+    return speculative_stats.report()
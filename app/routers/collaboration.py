@@ -1,14 +1,23 @@
 import asyncio
-import json
+from typing import List
 
 import redis.asyncio as redis
 from auth import decode_access_token, get_current_user
-from crud import check_document_access, update_document
+from batching import (SUBPROTOCOLS, OpBatcher, build_frame, decode_frame,
+                      encode_frame, encoded_channel, negotiate_subprotocol,
+                      publish_frame)
+from crud import (add_collaborators_bulk, check_document_access,
+                  get_document_collaborators, remove_collaborators_bulk,
+                  update_document)
 from database import get_db
 from fastapi import (APIRouter, Depends, HTTPException, WebSocket,
                      WebSocketDisconnect)
 from model.Collaboration import Collaboration
 from model.User import User
+from presence import (PresenceThrottle, get_presence_snapshot,
+                      presence_channel)
+from schema import (BulkCollaborationRequest, BulkCollaborationResponse,
+                    CollaboratorResponse)
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -70,6 +79,47 @@ async def remove_collaborator(
     await db.commit()
     return {"message": "Collaborator removed", "collaborator_id": collaborator_id}
 
+MAX_BULK_PAIRS = 5000
+
+@router.post("/collaboration/share/bulk", response_model=BulkCollaborationResponse)
+async def share_documents_bulk(
+    request: BulkCollaborationRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    if len(request.pairs) > MAX_BULK_PAIRS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_PAIRS} pairs per request.")
+    pairs = [(pair.document_id, pair.collaborator_id) for pair in request.pairs]
+    results = await add_collaborators_bulk(db, pairs, current_user.id)
+    return {"results": results}
+
+@router.delete("/collaboration/share/bulk", response_model=BulkCollaborationResponse)
+async def remove_collaborators_bulk_endpoint(
+    request: BulkCollaborationRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    if len(request.pairs) > MAX_BULK_PAIRS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_PAIRS} pairs per request.")
+    pairs = [(pair.document_id, pair.collaborator_id) for pair in request.pairs]
+    results = await remove_collaborators_bulk(db, pairs, current_user.id)
+    return {"results": results}
+
+@router.get("/documents/{document_id}/collaborators", response_model=List[CollaboratorResponse])
+async def list_collaborators(
+    document_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    doc = await check_document_access(db, document_id, current_user.id)
+    if not doc:
+        raise HTTPException(status_code=403, detail="You don't have access to this document")
+    rows = await get_document_collaborators(db, document_id)
+    return [
+        {"user_id": user.id, "username": user.username, "email": user.email, "added_at": collab.created_at}
+        for collab, user in rows
+    ]
+
 @router.websocket("/ws/collaboration/{document_id}")
 async def websocket_collaboration(websocket: WebSocket, document_id: int, db: AsyncSession = Depends(get_db)):
     try:
@@ -87,69 +137,98 @@ async def websocket_collaboration(websocket: WebSocket, document_id: int, db: As
         await websocket.close(code=1008, reason="Access denied")
         return
 
-    await websocket.accept()
+    subprotocol = negotiate_subprotocol(websocket.scope.get("subprotocols", []))
+    encoding = SUBPROTOCOLS.get(subprotocol, "json")
+    await websocket.accept(subprotocol=subprotocol)
 
     try:
         redis_client = await get_redis()
+        # Binary subscribers need undecoded payloads, so they listen on a connection of their own.
+        subscriber = redis_client if encoding == "json" else redis.from_url(REDIS_URL)
     except Exception as e:
         await websocket.close(code=1011, reason="Redis connection failed")
         return
     
-    pubsub = redis_client.pubsub()
+    pubsub = subscriber.pubsub()
     channel_name = f"doc:{document_id}"
+    presence_channel_name = presence_channel(document_id)
+    subscribed = [encoded_channel(channel_name, encoding), encoded_channel(presence_channel_name, encoding)]
     try:
-        await pubsub.subscribe(channel_name)
+        await pubsub.subscribe(*subscribed)
     except Exception as e:
         await websocket.close(code=1011, reason="Redis subscription failed")
         return
 
     server_doc = document.content
 
+    async def publish_ops(ops):
+        if any(op["op"] == "sync" for op in ops):
+            try:
+                await update_document(db, document_id, content=server_doc)
+            except Exception as e:
+                pass
+
+        try:
+            await publish_frame(redis_client, channel_name, build_frame(ops))
+        except Exception as e:
+            pass
+
+    batcher = OpBatcher(publish_ops)
+    presence = PresenceThrottle(redis_client, document_id, user_id)
+    await presence.open()
+
+    async def send_frame(data):
+        if isinstance(data, bytes):
+            await websocket.send_bytes(data)
+        else:
+            await websocket.send_text(data)
+
+    try:
+        snapshot = await get_presence_snapshot(redis_client, document_id)
+        if snapshot:
+            await send_frame(encode_frame(build_frame(snapshot), encoding))
+    except Exception as e:
+        pass
+
     async def listen_to_websocket():
         nonlocal server_doc
         while True:
-            msg = await websocket.receive_text()
-            try:
-                op = json.loads(msg)
-                op["user_id"] = user_id
-            except json.JSONDecodeError:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            data = message.get("bytes") if message.get("bytes") is not None else message.get("text")
+            if data is None:
                 continue
 
-            if op["op"] == "insert":
-                pos = op["position"]
-                server_doc = server_doc[:pos] + op["text"] + server_doc[pos:]
-            elif op["op"] == "delete":
-                pos = op["position"]
-                length = op.get("length", 1)
-                server_doc = server_doc[:pos] + server_doc[pos + length:]
-            elif op["op"] == "sync":
-                server_doc = op.get("content", server_doc)
-                try:
-                    await update_document(db, document_id, content=server_doc)
-                except Exception as e:
-                    pass
-
-            try:
-                subscribers = await redis_client.publish(channel_name, json.dumps(op))
-            except Exception as e:
-                pass
+            for op in decode_frame(data):
+                if op["op"] == "presence":
+                    await presence.update(op["state"])
+                    continue
+                op["user_id"] = user_id
+                if op["op"] == "insert":
+                    pos = op["position"]
+                    server_doc = server_doc[:pos] + op["text"] + server_doc[pos:]
+                elif op["op"] == "delete":
+                    pos = op["position"]
+                    length = op.get("length", 1)
+                    server_doc = server_doc[:pos] + server_doc[pos + length:]
+                elif op["op"] == "sync":
+                    server_doc = op.get("content", server_doc)
+
+                await batcher.add(op)
 
     async def listen_to_redis():
         try:
             async for message in pubsub.listen():
                 if message and message['type'] == 'message':
                     try:
-                        op_data = json.loads(message["data"])
-                    except Exception as e:
-                        pass
-                    
-                    try:
-                        await websocket.send_text(message["data"])
+                        await send_frame(message["data"])
                     except Exception as e:
                         break
         except Exception as e:
             pass
 
+    keep_alive = asyncio.create_task(presence.keep_alive())
     try:
         await asyncio.gather(listen_to_websocket(), listen_to_redis())
     except WebSocketDisconnect:
@@ -157,6 +236,11 @@ async def websocket_collaboration(websocket: WebSocket, document_id: int, db: As
     except Exception as e:
         pass
     finally:
-        await pubsub.unsubscribe(channel_name)
+        keep_alive.cancel()
+        await batcher.close()
+        await presence.close()
+        await pubsub.unsubscribe(*subscribed)
         await pubsub.close()
+        if subscriber is not redis_client:
+            await subscriber.close()
         await redis_client.close()
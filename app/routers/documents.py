@@ -1,16 +1,25 @@
+import tarfile
+import tempfile
+import time
 from typing import List
 
 from auth import get_current_user
-from crud import (check_document_access, create_document, delete_document,
-                  update_document)
-from database import get_db
-from fastapi import APIRouter, Depends, HTTPException
+from crud import (check_document_access, create_document,
+                  create_documents_bulk, delete_document,
+                  stream_accessible_documents, update_document)
+from database import async_session, get_db
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import iterate_in_threadpool
+from fastapi.responses import StreamingResponse
 from model.Collaboration import Collaboration
 from model.Document import Document
 from model.User import User
 from schema import DocumentCreate, DocumentResponse, DocumentUpdate
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from transfer import (EXPORT_BATCH_SIZE, EXPORT_FORMATS, IMPORT_BATCH_SIZE,
+                      iter_ndjson_documents, iter_tar_batches,
+                      markdown_entry, ndjson_line, tar_end)
 
 router = APIRouter()
 
@@ -37,6 +46,81 @@ async def list_documents(
 
     return all_docs
 
+@router.get("/documents/export")
+async def export_documents(
+    format: str = "ndjson",
+    current_user: User = Depends(get_current_user),
+):
+    """Stream every accessible document as NDJSON or a tar of Markdown files."""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format: {format}")
+    user_id = current_user.id
+    encode = ndjson_line if format == "ndjson" else markdown_entry
+
+    async def stream_export():
+        # The request-scoped session is closed once the endpoint returns, so the export owns its own.
+        async with async_session() as session:
+            async for rows in stream_accessible_documents(session, user_id, EXPORT_BATCH_SIZE):
+                yield b"".join(encode(row) for row in rows)
+        if format == "tar":
+            yield tar_end()
+
+    return StreamingResponse(
+        stream_export(),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="documents.{format}"'},
+    )
+
+@router.post("/documents/import")
+async def import_documents(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Ingest an NDJSON or tar export as new documents owned by the current user."""
+    started = time.perf_counter()
+    imported = 0
+    skipped = 0
+    batch = []
+
+    async def add(document):
+        nonlocal imported, skipped, batch
+        if document is None:
+            skipped += 1
+            return
+        batch.append(document)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await create_documents_bulk(db, batch, current_user.id)
+            imported += len(batch)
+            batch = []
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type == EXPORT_FORMATS["tar"]:
+        with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as spool:
+            async for chunk in request.stream():
+                spool.write(chunk)
+            spool.seek(0)
+            try:
+                # Tar parsing and spool reads are blocking, so they run in the threadpool a batch at a time.
+                async for documents in iterate_in_threadpool(iter_tar_batches(spool)):
+                    for document in documents:
+                        await add(document)
+            except tarfile.TarError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid tar archive: {str(e)}")
+    else:
+        async for document in iter_ndjson_documents(request.stream()):
+            await add(document)
+
+    await create_documents_bulk(db, batch, current_user.id)
+    imported += len(batch)
+    elapsed = time.perf_counter() - started
+    return {
+        "imported": imported,
+        "skipped": skipped,
+        "seconds": round(elapsed, 3),
+        "documents_per_second": round(imported / elapsed, 1) if elapsed else None,
+    }
+
 @router.post("/documents", response_model=DocumentResponse)
 async def create_document_endpoint(
     document: DocumentCreate,
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -36,4 +36,25 @@ class DocumentResponse(BaseModel):
 	owner_id: int
 	created_at: datetime
 	class Config:
-		from_attributes = True
\ No newline at end of file
+		from_attributes = True
+
+class CollaborationPair(BaseModel):
+	document_id: int
+	collaborator_id: int
+
+class BulkCollaborationRequest(BaseModel):
+	pairs: List[CollaborationPair]
+
+class CollaborationResult(BaseModel):
+	document_id: int
+	collaborator_id: int
+	status: str
+
+class BulkCollaborationResponse(BaseModel):
+	results: List[CollaborationResult]
+
+class CollaboratorResponse(BaseModel):
+	user_id: int
+	username: str
+	email: str
+	added_at: Optional[datetime] = None
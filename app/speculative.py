@@ -0,0 +1,189 @@
+"""Speculative decoding for the llama.cpp assistant model.
+
+Run as a script to check a mode against plain decoding at temperature 0:
+
+    python speculative.py --model granite.gguf --prompt-file prompt.txt --mode prompt_lookup
+"""
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+SPECULATIVE_MODES = ("off", "prompt_lookup", "draft")
+
+# off | prompt_lookup | draft (draft needs AI_DRAFT_MODEL_PATH, a small GGUF sharing the main model's vocabulary).
+AI_SPECULATIVE_MODE = os.getenv("AI_SPECULATIVE_MODE", "off")
+# Endpoints that decode speculatively when a mode is enabled: any of ask, ask_web, jobs. None unless listed.
+AI_SPECULATIVE_ENDPOINTS = {name.strip() for name in os.getenv("AI_SPECULATIVE_ENDPOINTS", "").split(",") if name.strip()}
+AI_DRAFT_MODEL_PATH = os.getenv("AI_DRAFT_MODEL_PATH")
+AI_DRAFT_TOKENS = int(os.getenv("AI_DRAFT_TOKENS", "10"))
+
+
+class SmallModelDraft(LlamaDraftModel):
+    """Greedy drafts from a small GGUF; llama.cpp reuses its KV cache across calls via prefix matching."""
+
+    def __init__(self, model_path: str, num_pred_tokens: int = AI_DRAFT_TOKENS, **kwargs: Any):
+        self.model = Llama(model_path=model_path, logits_all=False, verbose=False, **kwargs)
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        draft = []
+        for token in self.model.generate(input_ids.tolist(), temp=0.0, top_k=1):
+            if token == self.model.token_eos():
+                break
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+
+class MeasuredDraftModel(LlamaDraftModel):
+    """Counts drafted and accepted tokens around another draft model.
+
+    Llama.generate calls the draft with the whole sequence after every verification step, which
+    advances by the accepted draft tokens plus one token sampled from the main model.
+    """
+
+    def __init__(self, draft: LlamaDraftModel):
+        self.draft = draft
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.drafted = 0
+        self.accepted = 0
+        self._previous_length: Optional[int] = None
+        self._previous_draft = 0
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        if self._previous_length is not None:
+            advanced = len(input_ids) - self._previous_length
+            self.accepted += max(0, min(advanced - 1, self._previous_draft))
+        draft = self.draft(input_ids, **kwargs)
+        self._previous_length = len(input_ids)
+        self._previous_draft = len(draft)
+        self.drafted += len(draft)
+        return draft
+
+
+def check_speculative_support(model_path: str):
+    """Raise ValueError if speculative decoding could change the output of the model at model_path.
+
+    Llama.generate drops rejected draft tokens by trimming the KV cache. Recurrent and hybrid models
+    (such as the Mamba layers of granite-4.0-h) keep state that cannot be partially trimmed, so the
+    rejected drafts would stay in it and later tokens could drift from plain decoding.
+    """
+    is_recurrent = getattr(llama_cpp, "llama_model_is_recurrent", None)
+    is_hybrid = getattr(llama_cpp, "llama_model_is_hybrid", None)
+    if is_recurrent is None or is_hybrid is None:
+        raise ValueError("This llama-cpp-python cannot tell recurrent models apart; upgrade it to use speculative decoding")
+
+    params = llama_cpp.llama_model_default_params()
+    params.vocab_only = True
+    model = llama_cpp.llama_model_load_from_file(model_path.encode("utf-8"), params)
+    if model is None:
+        raise ValueError(f"Failed to load model from file: {model_path}")
+    try:
+        if is_recurrent(model) or is_hybrid(model):
+            raise ValueError(
+                f"Speculative decoding is not supported for {model_path}: its recurrent state cannot be "
+                "rolled back when draft tokens are rejected"
+            )
+    finally:
+        llama_cpp.llama_model_free(model)
+
+
+def build_draft_model(model_path: str, mode: str = AI_SPECULATIVE_MODE,
+                      draft_model_path: Optional[str] = AI_DRAFT_MODEL_PATH,
+                      n_ctx: int = 8192) -> Optional[MeasuredDraftModel]:
+    """Draft model for the main model at model_path; n_ctx should match the main model's context."""
+    if mode == "off":
+        return None
+    if mode not in SPECULATIVE_MODES:
+        raise ValueError(f"Unknown speculative mode: {mode}")
+    check_speculative_support(model_path)
+    if mode == "prompt_lookup":
+        return MeasuredDraftModel(LlamaPromptLookupDecoding(num_pred_tokens=AI_DRAFT_TOKENS))
+    if not draft_model_path:
+        raise ValueError("AI_SPECULATIVE_MODE=draft requires AI_DRAFT_MODEL_PATH")
+    return MeasuredDraftModel(SmallModelDraft(draft_model_path, n_ctx=n_ctx))
+
+
+class SpeculativeStats:
+    """Cumulative decode statistics per endpoint, split by whether speculation was used."""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, endpoint: str, speculative: bool, tokens: int, seconds: float,
+               draft: Optional[MeasuredDraftModel] = None):
+        key = f"{endpoint}:{'speculative' if speculative else 'plain'}"
+        stats = self._stats.setdefault(key, {"generations": 0, "tokens": 0, "seconds": 0.0, "drafted": 0, "accepted": 0})
+        stats["generations"] += 1
+        stats["tokens"] += tokens
+        stats["seconds"] += seconds
+        if speculative and draft is not None:
+            stats["drafted"] += draft.drafted
+            stats["accepted"] += draft.accepted
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for key, stats in self._stats.items():
+            report[key] = {
+                **stats,
+                "seconds": round(stats["seconds"], 3),
+                "tokens_per_second": round(stats["tokens"] / stats["seconds"], 2) if stats["seconds"] else None,
+                "acceptance_rate": round(stats["accepted"] / stats["drafted"], 4) if stats["drafted"] else None,
+            }
+        return report
+
+
+def _decode(llm: Llama, prompt: str, max_tokens: int) -> Dict[str, Any]:
+    started = time.perf_counter()
+    result = llm(prompt, max_tokens=max_tokens, temperature=0.0, stop=["<|end_of_text|>", "<|end_of_role|>"])
+    seconds = time.perf_counter() - started
+    tokens = result["usage"]["completion_tokens"]
+    return {"text": result["choices"][0]["text"], "tokens": tokens, "seconds": round(seconds, 3),
+            "tokens_per_second": round(tokens / seconds, 2) if seconds else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare speculative and plain decoding at temperature 0")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--prompt-file", required=True)
+    parser.add_argument("--mode", choices=SPECULATIVE_MODES[1:], default="prompt_lookup")
+    parser.add_argument("--draft-model", default=AI_DRAFT_MODEL_PATH, help="small GGUF for --mode draft")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--n-ctx", type=int, default=8192)
+    args = parser.parse_args()
+
+    with open(args.prompt_file, "r") as f:
+        prompt = f.read()
+
+    draft = build_draft_model(args.model, args.mode, args.draft_model, n_ctx=args.n_ctx)
+
+    llm = Llama(model_path=args.model, n_ctx=args.n_ctx, n_gpu_layers=-1, logits_all=False, verbose=False)
+    plain = _decode(llm, prompt, args.max_tokens)
+    del llm
+
+    llm = Llama(model_path=args.model, n_ctx=args.n_ctx, n_gpu_layers=-1, draft_model=draft, verbose=False)
+    speculative = _decode(llm, prompt, args.max_tokens)
+    speculative["acceptance_rate"] = round(draft.accepted / draft.drafted, 4) if draft.drafted else None
+
+    print(json.dumps({
+        "mode": args.mode,
+        "outputs_match": plain["text"] == speculative["text"],
+        "plain": {key: value for key, value in plain.items() if key != "text"},
+        "speculative": {key: value for key, value in speculative.items() if key != "text"},
+        "speedup": round(speculative["tokens_per_second"] / plain["tokens_per_second"], 2)
+        if plain["tokens_per_second"] and speculative["tokens_per_second"] else None,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import io
+import json
+import re
+import tarfile
+import time
+from typing import AsyncIterator, Iterator, List, Optional
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "tar": "application/x-tar",
+}
+EXPORT_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+
+_FRONT_MATTER = re.compile(r"\A---\n(.*?)\n---\n", re.DOTALL)
+
+
+def _slug(title: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "-", title).strip("-").lower()[:80] or "untitled"
+
+
+def ndjson_line(row) -> bytes:
+    return (json.dumps({
+        "id": row.id,
+        "title": row.title,
+        "content": row.content or "",
+        "owner_id": row.owner_id,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }) + "\n").encode()
+
+
+def markdown_entry(row) -> bytes:
+    """One tar member: a Markdown file whose front matter carries the document metadata."""
+    front_matter = json.dumps({
+        "id": row.id,
+        "title": row.title,
+        "owner_id": row.owner_id,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    })
+    body = f"---\n{front_matter}\n---\n{row.content or ''}".encode()
+    info = tarfile.TarInfo(name=f"{row.id}-{_slug(row.title)}.md")
+    info.size = len(body)
+    info.mtime = int(row.created_at.timestamp()) if row.created_at else int(time.time())
+    padding = (tarfile.BLOCKSIZE - len(body) % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+    return info.tobuf(format=tarfile.PAX_FORMAT) + body + b"\0" * padding
+
+
+def tar_end() -> bytes:
+    return b"\0" * (tarfile.BLOCKSIZE * 2)
+
+
+def _document_fields(record: dict) -> Optional[dict]:
+    title = record.get("title")
+    if not isinstance(title, str):
+        return None
+    content = record.get("content") or ""
+    if not isinstance(content, str):
+        return None
+    return {"title": title[:255], "content": content}
+
+
+async def iter_ndjson_documents(chunks: AsyncIterator[bytes]) -> AsyncIterator[Optional[dict]]:
+    """Yield document fields for each NDJSON line, or None for a line that could not be parsed."""
+    # Only the new chunk is split; pieces of a line spanning several chunks are joined once it ends.
+    partial: List[bytes] = []
+    async for chunk in chunks:
+        *lines, tail = chunk.split(b"\n")
+        if lines:
+            lines[0] = b"".join(partial) + lines[0]
+            partial = []
+        for line in lines:
+            if line.strip():
+                yield _parse_ndjson_line(line)
+        if tail:
+            partial.append(tail)
+    last = b"".join(partial)
+    if last.strip():
+        yield _parse_ndjson_line(last)
+
+
+def _parse_ndjson_line(line: bytes) -> Optional[dict]:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return _document_fields(record) if isinstance(record, dict) else None
+
+
+def iter_tar_documents(fileobj: io.IOBase) -> Iterator[Optional[dict]]:
+    """Yield document fields for each Markdown member of an exported tar stream."""
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith(".md"):
+                continue
+            text = archive.extractfile(member).read().decode("utf-8", errors="replace")
+            match = _FRONT_MATTER.match(text)
+            if not match:
+                name = member.name.rsplit("/", 1)[-1][:-3]
+                yield {"title": name[:255], "content": text}
+                continue
+            try:
+                meta = json.loads(match.group(1))
+            except ValueError:
+                yield None
+                continue
+            if not isinstance(meta, dict):
+                yield None
+                continue
+            meta["content"] = text[match.end():]
+            yield _document_fields(meta)
+
+
+def iter_tar_batches(fileobj: io.IOBase, batch_size: int = IMPORT_BATCH_SIZE) -> Iterator[List[Optional[dict]]]:
+    """Group iter_tar_documents so a caller can step it from a worker thread once per batch."""
+    batch: List[Optional[dict]] = []
+    for document in iter_tar_documents(fileobj):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
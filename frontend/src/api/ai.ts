@@ -1,4 +1,4 @@
-import apiClient from './client';
+import apiClient, { getAccessToken } from './client';
 
 export interface AIRequest {
   context: string;
@@ -25,11 +25,13 @@ export const aiApi = {
     try {
       const baseUrl = apiClient.defaults.baseURL || '';
       const endpoint = options?.useWeb ? '/ai/ask_web' : '/ai/ask';
+      const token = getAccessToken();
 
       const response = await fetch(`${baseUrl}${endpoint}`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          ...(token ? { Authorization: `Bearer ${token}` } : {}),
         },
         body: JSON.stringify(request),
       });
@@ -1,11 +1,17 @@
 
 export interface WebSocketOperation {
   user_id: number;
-  op: 'insert' | 'delete' | 'sync';
+  op: 'insert' | 'delete' | 'sync' | 'presence';
   position: number;
   text?: string;
   length?: number;
   content?: string;
+  state?: Record<string, unknown> | null;
+}
+
+export interface WebSocketBatchFrame {
+  op: 'batch';
+  ops: WebSocketOperation[];
 }
 
 export type WebSocketMessageHandler = (operation: WebSocketOperation) => void;
@@ -44,7 +50,7 @@ class WebSocketService {
     
     
     try {
-      this.ws = new WebSocket(wsUrl);
+      this.ws = new WebSocket(wsUrl, ['docqent.json']);
 
       this.ws.onopen = () => {
         this.reconnectAttempts = 0;
@@ -52,8 +58,9 @@ class WebSocketService {
 
       this.ws.onmessage = (event) => {
         try {
-          const operation: WebSocketOperation = JSON.parse(event.data);
-          onMessage(operation);
+          const frame: WebSocketOperation | WebSocketBatchFrame = JSON.parse(event.data);
+          const operations = frame.op === 'batch' ? frame.ops : [frame];
+          operations.forEach(onMessage);
         } catch (error) {
         }
       };